@@ -6,6 +6,7 @@ import enum
 import math
 import random
 
+import numpy # bundled with blender
 import bpy # blender api
 import mathutils # matrix stuff
 
@@ -103,21 +104,53 @@ def _triangle_space_definition_with_tangent_space():
 
 ### Fix flattened uvs ; only run when triangle space has changed
 
-def set_block_faces_uv_to_triangle_uv(block: bpy.types.Mesh, block_os_to_ts: mathutils.Matrix, ts_xy1_to_uv: mathutils.Matrix):
-    block_os_to_ts_dir = block_os_to_ts.to_3x3()
+def compute_block_faces_triangle_uv(block: bpy.types.Mesh, block_os_to_ts: mathutils.Matrix, ts_xy1_to_uv: mathutils.Matrix) -> typing.Tuple[numpy.ndarray, numpy.ndarray]:
+    # Bulk version of the per-loop projection : fetch all loop data in flat arrays, and do the matrix products on numpy arrays.
+    # Returns (current uvs, reprojected uvs), both (nb_loops, 2).
     block.calc_normals_split()
+    nb_loops = len(block.loops)
+    loop_normals = numpy.empty(nb_loops * 3, dtype = numpy.float32)
+    block.loops.foreach_get("normal", loop_normals)
+    loop_vertex_indices = numpy.empty(nb_loops, dtype = numpy.int32)
+    block.loops.foreach_get("vertex_index", loop_vertex_indices)
+    vertex_positions = numpy.empty(len(block.vertices) * 3, dtype = numpy.float32)
+    block.vertices.foreach_get("co", vertex_positions)
     block_uvs = block.uv_layers["UVMap"].data
-    for loop in block.loops:
-        normal_ts = (block_os_to_ts_dir @ loop.normal).normalized()
-        if abs(normal_ts.z) > 0.5:
-            # Only for faces, as more vertical surfaces will not appear on the flat triangle
-            # They will use manual uvs outside of the triangle uv space
-            pos_ts = block_os_to_ts @ block.vertices[loop.vertex_index].co.to_4d()
-            uv = ts_xy1_to_uv @ mathutils.Vector((pos_ts.x, pos_ts.y, 1.))
-            if normal_ts.z < 0:
-                # Shift backface uv uvs to not overlap for normal map computations.
-                uv.x += 1
-            block_uvs[loop.index].uv = uv
+    current_uvs = numpy.empty(nb_loops * 2, dtype = numpy.float32)
+    block_uvs.foreach_get("uv", current_uvs)
+    current_uvs = current_uvs.reshape(nb_loops, 2)
+    # matrices as numpy arrays ; mathutils iterates on rows so the layout is identical
+    os_to_ts = numpy.array(block_os_to_ts, dtype = numpy.float64)
+    xy1_to_uv = numpy.array(ts_xy1_to_uv, dtype = numpy.float64)
+    # row vectors, so v @ m.T == colvec(m @ v)
+    normals_ts = loop_normals.reshape(nb_loops, 3) @ os_to_ts[:3, :3].T
+    normals_ts_z = normals_ts[:, 2] / numpy.linalg.norm(normals_ts, axis = 1)
+    positions_ts = vertex_positions.reshape(-1, 3)[loop_vertex_indices] @ os_to_ts[:3, :3].T + os_to_ts[:3, 3]
+    uvs = positions_ts[:, :2] @ xy1_to_uv[:, :2].T + xy1_to_uv[:, 2]
+    # Shift backface uv uvs to not overlap for normal map computations.
+    uvs[normals_ts_z < 0, 0] += 1
+    # Only for faces, as more vertical surfaces will not appear on the flat triangle
+    # They will use manual uvs outside of the triangle uv space
+    is_face = numpy.abs(normals_ts_z) > 0.5
+    reprojected_uvs = numpy.where(is_face[:, None], uvs, current_uvs).astype(numpy.float32)
+    return (current_uvs, reprojected_uvs)
+
+def set_blocks_faces_uv_to_triangle_uv(blocks: typing.List[bpy.types.Mesh], block_os_to_ts: mathutils.Matrix, ts_xy1_to_uv: mathutils.Matrix, dry_run: bool = True, threshold: float = 1e-5) -> typing.Dict[str, numpy.ndarray]:
+    # All blocks share the same block_os_to_ts, so all lods are processed at once.
+    # With dry_run, only report loops whose uv would change by more than threshold, without writing anything.
+    # Returns mesh name -> changed loop indices.
+    changes = {}
+    for block in blocks:
+        current_uvs, reprojected_uvs = compute_block_faces_triangle_uv(block, block_os_to_ts, ts_xy1_to_uv)
+        changed_loops = numpy.flatnonzero(numpy.any(numpy.abs(reprojected_uvs - current_uvs) > threshold, axis = 1))
+        changes[block.name] = changed_loops
+        print (f"{block.name}: {len(changed_loops)}/{len(current_uvs)} loop uvs {'would change' if dry_run else 'changed'}")
+        for loop_id in changed_loops:
+            print (f"    loop {loop_id}: {FloatN(current_uvs[loop_id])} -> {FloatN(reprojected_uvs[loop_id])}")
+        if not dry_run and len(changed_loops) > 0:
+            block.uv_layers["UVMap"].data.foreach_set("uv", reprojected_uvs.ravel())
+            block.update()
+    return changes
 
 ### Read blender data
 
@@ -362,8 +395,9 @@ if __name__ == "__main__":
     assert block_lod0.matrix_world == block_lod2.matrix_world
     block_os_to_ts, ts_xy1_to_uv = build_transformation_matrices(triangle, block_lod0)
 
-    # Only run if triangle space has changed, as it changes uv and all dependent values (normal maps, etc) must be redone.
-    #set_block_faces_uv_to_triangle_uv(block_lod0.data, block_os_to_ts, ts_xy1_to_uv)
+    # Only write if triangle space has changed, as it changes uv and all dependent values (normal maps, etc) must be redone.
+    # Dry run by default : only lists loops with outdated uvs. Set dry_run = False to apply.
+    set_blocks_faces_uv_to_triangle_uv([block.data for block in [block_lod0, block_lod1, block_lod2]], block_os_to_ts, ts_xy1_to_uv, dry_run = True)
 
     # Finding the right strip size and split is NP-complete so I am not interested in trying any "optimal" solution algorithmically.
     # For lod0 model, strips = 4x7+12x4 vertices, so using 8 vertice instances leads to 10 instances at 7 or 8 vertices.